@@ -0,0 +1,33 @@
+# Copyright 2020 The Kubric Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Numeric kernels for per-frame animation data, jit-compiled with numba when available."""
+
+import numpy as np
+
+try:
+  from numba import njit
+except ImportError:  # e.g. blender's bundled python without numba: plain numpy
+  def njit(*args, **kwargs):
+    return lambda fn: fn
+
+
+@njit(cache=True, fastmath=True)
+def pb_to_blender_quats(q):
+  """Converts (N, 4) pyBullet XYZW quaternions into Blender WXYZ quaternions."""
+  out = np.empty_like(q)
+  out[:, 0] = q[:, 3]
+  out[:, 1] = q[:, 0]
+  out[:, 2] = q[:, 1]
+  out[:, 3] = q[:, 2]
+  return out
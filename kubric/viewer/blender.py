@@ -13,7 +13,13 @@
 # limitations under the License.
 """Implementation of blender backend."""
 
+import concurrent.futures
+from typing import Dict, Iterable, Tuple
+
+import bmesh
 import bpy
+import mathutils
+import numpy as np
 from kubric.viewer import interface
 
 
@@ -38,6 +44,8 @@ class Object3D(interface.Object3D):
       "position": "location",
       "quaternion": "rotation_quaternion"
   }
+  # Value of 'LINEAR' in the Keyframe.interpolation enum (as used by foreach_set).
+  _linear_interpolation = 1
 
   def __init__(self, blender_object):  # , name=None):
     super().__init__(self)
@@ -65,6 +73,51 @@ class Object3D(interface.Object3D):
     data_path = Object3D._member_to_blender_data_path[member]
     self._blender_object.keyframe_insert(data_path=data_path, frame=frame)
 
+  def keyframe_insert_batch(self, member: str, frames, values):
+    """Inserts keyframes for all `frames` at once, writing the fcurves directly.
+
+    Avoids one `keyframe_insert` round-trip per frame and component, which
+    dominates the cost of dumping long simulations into blender.
+
+    Args:
+      member: the keyframed property (e.g. "position" or "quaternion").
+      frames: sequence of F frame numbers.
+      values: array of shape (F, D), the value of `member` at each frame.
+    """
+    assert hasattr(self, member), "cannot keyframe an undefined property"
+    data_path = Object3D._member_to_blender_data_path[member]
+    frames = np.asarray(frames, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32)
+    assert values.ndim == 2 and values.shape[0] == frames.shape[0]
+
+    if self._blender_object.animation_data is None:
+      self._blender_object.animation_data_create()
+    animation_data = self._blender_object.animation_data
+    if animation_data.action is None:
+      animation_data.action = bpy.data.actions.new(self._blender_object.name + "Action")
+    fcurves = animation_data.action.fcurves
+
+    for index in range(values.shape[1]):
+      fcurve = fcurves.find(data_path, index=index)
+      if fcurve is None:
+        # grouping the transform fcurves lets blender evaluate them together
+        fcurve = fcurves.new(data_path, index=index, action_group="LocRot")
+      points = fcurve.keyframe_points
+      start = len(points)
+      points.add(frames.shape[0])
+      # (frame, value) pairs are stored interleaved in a flat buffer
+      co = np.empty(2 * len(points), dtype=np.float32)
+      points.foreach_get("co", co)
+      co[2 * start::2] = frames
+      co[2 * start + 1::2] = values[:, index]
+      points.foreach_set("co", co)
+      # keyframe_points.add always creates bezier keys (ignoring the user preferences)
+      interpolation = np.empty(len(points), dtype=np.int32)
+      points.foreach_get("interpolation", interpolation)
+      interpolation[start:] = Object3D._linear_interpolation
+      points.foreach_set("interpolation", interpolation)
+      fcurve.update()
+
 
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
@@ -75,30 +128,66 @@ class Scene(interface.Scene):
   # TODO: create a named scene, and refer via bpy.data.scenes['Scene']
 
   def __init__(self):
+    self._scene = bpy.context.scene
+    self._render = self._scene.render
+    self._cycles = self._scene.cycles
     super().__init__()
-    bpy.context.scene.render.fps = 24
-    bpy.context.scene.render.fps_base = 1.0
+    self._render.fps = 24
+    self._render.fps_base = 1.0
+    # (name, pointer) of the meshes imported by add_from_file, shared by all instances of an
+    # asset. (Not the mesh itself, as Renderer.clear_scene may have removed it since.)
+    self._mesh_cache: Dict[str, Tuple[str, int]] = {}
 
   def _set_frame_start(self, value):
     super()._set_frame_start(value)
-    bpy.context.scene.frame_start = value
+    self._scene.frame_start = value
 
   def _set_frame_end(self, value):
     super()._set_frame_end(value)
-    bpy.context.scene.frame_end = value
+    self._scene.frame_end = value
 
-  def add_from_file(self, path: str, axis_forward='Y', axis_up='Z', name=None) -> Object3D:
+  def _import_mesh_data(self, path: str, axis_forward='Y', axis_up='Z') -> bpy.types.Mesh:
+    """Imports the mesh of an OBJ file, discarding the object created by the importer."""
     bpy.ops.import_scene.obj(filepath=str(path), axis_forward=axis_forward, axis_up=axis_up)
     # WARNING: bpy.context.object does not work here...
     blender_objects = bpy.context.selected_objects[:]
     assert len(blender_objects) == 1
     blender_object = blender_objects[0]
-    if name:
-        blender_object.name = name
-    return Object3D(blender_objects[0])
+    mesh = blender_object.data
+    # the importer expresses the axis conversion as an object transform; bake it into the mesh
+    mesh.transform(blender_object.matrix_world)
+    bpy.data.objects.remove(blender_object, do_unlink=True)
+    return mesh
+
+  def add_from_file(self, path: str, axis_forward='Y', axis_up='Z', name=None,
+                    asset_id=None) -> Object3D:
+    """Adds an instance of the OBJ file to the scene.
+
+    The file is only parsed the first time a given `asset_id` (defaults to the path) is
+    added; further instances link the same mesh datablock, and therefore share its
+    materials. Per-instance material overrides require `material_slots[i].link = 'OBJECT'`.
+
+    Only rigid-body animation (keyframed position/quaternion) is supported, so deformation
+    motion is disabled and cycles does not need to re-export the mesh for every frame.
+    """
+    key = asset_id if asset_id is not None else str(path)
+    mesh = None
+    if key in self._mesh_cache:
+      mesh_name, mesh_pointer = self._mesh_cache[key]
+      mesh = bpy.data.meshes.get(mesh_name)
+      if mesh is not None and mesh.as_pointer() != mesh_pointer:
+        mesh = None  # removed, and the name reused by another mesh
+    if mesh is None:
+      mesh = self._import_mesh_data(path, axis_forward, axis_up)
+      self._mesh_cache[key] = (mesh.name, mesh.as_pointer())
+    blender_object = bpy.data.objects.new(name if name else mesh.name, mesh)
+    # NOTE: use_motion_blur must stay on, otherwise cycles writes no vector (flow) pass
+    blender_object.cycles.use_deform_motion = False
+    self._scene.collection.objects.link(blender_object)
+    return Object3D(blender_object)
 
   def add(self, obj):
-    bpy.context.scene.collection.objects.link(obj._blender_object)
+    self._scene.collection.objects.link(obj._blender_object)
 
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
@@ -140,15 +229,18 @@ class AmbientLight(interface.AmbientLight):
   def __init__(self, color=0x030303, intensity=1):
     interface.AmbientLight.__init__(self, color=color, intensity=intensity)
 
+  @staticmethod
+  def _background_node():
+    # not cached: Renderer.set_up_background may rebuild the world node tree
+    return bpy.context.scene.world.node_tree.nodes["Background"]
+
   def _set_color(self, value):
     super()._set_color(value)
-    bpy.context.scene.world.node_tree.nodes["Background"].inputs[
-      'Color'].default_value = self.color
+    self._background_node().inputs['Color'].default_value = self.color
 
   def _set_intensity(self, value):
     super()._set_intensity(value)
-    bpy.context.scene.world.node_tree.nodes["Background"].inputs[
-      'Strength'].default_value = self.intensity
+    self._background_node().inputs['Strength'].default_value = self.intensity
 
 
 # ------------------------------------------------------------------------------
@@ -228,21 +320,41 @@ class Geometry():
   pass
 
 
+def _prototype_mesh(name: str, create_fn) -> bpy.types.Mesh:
+  """Returns the prototype mesh `name`, building it with `create_fn(bmesh)` on first use."""
+  mesh = bpy.data.meshes.get(name)
+  if mesh is None:
+    bm = bmesh.new()
+    # a UV map (like the primitive_*_add operators create), otherwise the UV pass is empty
+    bm.loops.layers.uv.new()
+    create_fn(bm)
+    mesh = bpy.data.meshes.new(name)
+    bm.to_mesh(mesh)
+    bm.free()
+  return mesh
+
+
 class BoxGeometry(interface.BoxGeometry, Geometry):
   def __init__(self, width=1.0, height=1.0, depth=1.0):
     assert width == height and width == depth, "blender only creates unit cubes"
     interface.BoxGeometry.__init__(self, width=width, height=height,
                                    depth=depth)
-    bpy.ops.mesh.primitive_cube_add(size=width)
-    self._blender_object = bpy.context.object
+    # copies a prototype rather than bpy.ops.mesh.primitive_cube_add (no operator/context)
+    proto = _prototype_mesh("CubeProto", lambda bm: bmesh.ops.create_cube(
+        bm, size=1.0, calc_uvs=True))
+    mesh = proto.copy()
+    mesh.transform(mathutils.Matrix.Scale(width, 4))
+    self._blender_object = bpy.data.objects.new("Cube", mesh)
 
 
 class PlaneGeometry(interface.Geometry, Geometry):
   def __init__(self, width: float = 1, height: float = 1,
       widthSegments: int = 1, heightSegments: int = 1):
     assert widthSegments == 1 and heightSegments == 1, "not implemented"
-    bpy.ops.mesh.primitive_plane_add()
-    self._blender_object = bpy.context.object
+    # same 2x2 plane as bpy.ops.mesh.primitive_plane_add()
+    proto = _prototype_mesh("PlaneProto", lambda bm: bmesh.ops.create_grid(
+        bm, x_segments=1, y_segments=1, size=1.0, calc_uvs=True))
+    self._blender_object = bpy.data.objects.new("Plane", proto.copy())
 
 
 class BufferGeometry(interface.BufferGeometry, Geometry):
@@ -284,8 +396,9 @@ class MeshPhongMaterial(interface.MeshPhongMaterial, Material):
     # TODO: apply specs
 
   def blender_apply(self, blender_object):
-    bpy.context.view_layer.objects.active = blender_object
-    bpy.ops.object.shade_smooth()
+    # (same as bpy.ops.object.shade_smooth, which requires the object to be in the view layer)
+    polygons = blender_object.data.polygons
+    polygons.foreach_set("use_smooth", np.ones(len(polygons), dtype=bool))
 
 
 class MeshFlatMaterial(interface.MeshFlatMaterial, Material):
@@ -294,8 +407,9 @@ class MeshFlatMaterial(interface.MeshFlatMaterial, Material):
     interface.Material.__init__(self, specs=specs)
 
   def blender_apply(self, blender_object):
-    bpy.context.view_layer.objects.active = blender_object
-    bpy.ops.object.shade_flat()
+    # (same as bpy.ops.object.shade_flat, which requires the object to be in the view layer)
+    polygons = blender_object.data.polygons
+    polygons.foreach_set("use_smooth", np.zeros(len(polygons), dtype=bool))
 
 
 class ShadowMaterial(interface.ShadowMaterial, Material):
@@ -330,9 +444,22 @@ class Mesh(interface.Mesh, Object3D):
     # --- Assigns the buffers to the object
     # TODO: is there a better way to achieve this?
     if isinstance(self.geometry, BufferGeometry):
-      vertices = self.geometry.attributes["position"].array.tolist()
-      faces = self.geometry.index.tolist()
-      self._blender_object.data.from_pydata(vertices, [], faces)
+      # bulk-copy the (uniform width) polygons, as from_pydata iterates in python
+      vertices = np.ascontiguousarray(self.geometry.attributes["position"].array,
+                                      dtype=np.float32).ravel()
+      faces = np.ascontiguousarray(self.geometry.index, dtype=np.int32)
+      num_polygons, polygon_size = faces.shape
+      mesh = self._blender_object.data
+      mesh.vertices.add(len(vertices) // 3)
+      mesh.vertices.foreach_set("co", vertices)
+      mesh.loops.add(faces.size)
+      mesh.loops.foreach_set("vertex_index", faces.ravel())
+      mesh.polygons.add(num_polygons)
+      mesh.polygons.foreach_set("loop_start", np.arange(0, faces.size, polygon_size,
+                                                        dtype=np.int32))
+      mesh.polygons.foreach_set("loop_total", np.full(num_polygons, polygon_size,
+                                                      dtype=np.int32))
+      mesh.update(calc_edges=True)
 
     # --- Adds the material to the object
     self._blender_object.data.materials.append(material._blender_material)
@@ -345,55 +472,68 @@ class Mesh(interface.Mesh, Object3D):
 
 
 class Renderer(interface.Renderer):
+  # Names of the world nodes that set_up_background configures (found again on later calls).
+  _world_node_names = {"mapping": "HDRI Mapping", "hdri": "HDRI", "camera_bg": "Camera Background"}
 
   def __init__(self, useBothCPUGPU=False):
+    # cache the handles, each bpy.context lookup walks the RNA context
+    self._scene = bpy.context.scene
+    self._render = self._scene.render
+    self._cycles = self._scene.cycles
+    self._prefs = bpy.context.preferences.addons['cycles'].preferences
     super().__init__()
     self.clear_scene()  # as blender has a default scene on load
-    bpy.context.scene.render.engine = 'CYCLES'
-    bpy.context.scene.cycles.samples = 128
-    bpy.context.scene.cycles.max_bounces = 6
-    bpy.context.scene.cycles.film_exposure = 1.5
-
-
-    # activate further render passes
-    view_layer = bpy.context.scene.view_layers['View Layer']
+    self._render.engine = 'CYCLES'
+    self._cycles.samples = 128
+    self._cycles.max_bounces = 6
+    self._cycles.film_exposure = 1.5
+    # large (power of two) tiles keep the GPU busy, adaptive sampling stops converged pixels
+    if hasattr(self._cycles, "tile_size"):  # blender >= 3.0
+      self._cycles.tile_size = 256
+    else:
+      self._render.tile_x = 256
+      self._render.tile_y = 256
+    self._cycles.use_adaptive_sampling = True
+    self._cycles.adaptive_threshold = 0.01
+    self._cycles.adaptive_min_samples = 16
+    # reuse BVH and compiled shaders across the frames of an animation
+    self._render.use_persistent_data = True
+
+    # further render passes are only activated on demand (see set_up_exr_output)
+    view_layer = self._scene.view_layers['View Layer']
     view_layer.cycles.use_denoising = True
-    view_layer.use_pass_vector = True  # flow
-    view_layer.use_pass_uv = True  # UV
-    view_layer.use_pass_normal = True  # surface normals
-    view_layer.cycles.use_pass_crypto_object = True  # segmentation
-    view_layer.cycles.pass_crypto_depth = 2
 
     # --- compute devices
     # derek, why is the rationale? → rendering on GPU only sometime faster than CPU+GPU
     # TODO: modify the logic to execute on CPU, GPU, CPU+GPU
-    cyclePref = bpy.context.preferences.addons['cycles'].preferences
-    cyclePref.compute_device_type = 'CUDA'
-    for dev in cyclePref.devices:
+    self._prefs.compute_device_type = 'CUDA'
+    for dev in self._prefs.devices:
       if dev.type == "CPU" and useBothCPUGPU is False:
         dev.use = False
       else:
         dev.use = True
-    bpy.context.scene.cycles.device = 'GPU'
-    for dev in cyclePref.devices:
+    self._cycles.device = 'GPU'
+    for dev in self._prefs.devices:
       print(dev)
       print(dev.use)
 
   def set_background_transparent(self, film_transparent: bool):
-    bpy.context.scene.render.film_transparent = film_transparent
+    self._render.film_transparent = film_transparent
 
   def set_size(self, width: int, height: int):
     super().set_size(width, height)
-    bpy.context.scene.render.resolution_x = self.width
-    bpy.context.scene.render.resolution_y = self.height
+    self._render.resolution_x = self.width
+    self._render.resolution_y = self.height
 
   def set_clear_color(self, color: int, alpha: float):
     raise NotImplementableError()
 
   def clear_scene(self):
-    bpy.ops.wm.read_homefile()
-    bpy.ops.object.select_all(action='SELECT')
-    bpy.ops.object.delete()
+    # removes the datablocks directly, as bpy.ops goes through undo/depsgraph updates
+    for collection in (bpy.data.objects, bpy.data.meshes, bpy.data.materials,
+                       bpy.data.lights, bpy.data.cameras, bpy.data.actions):
+      for datablock in list(collection):
+        collection.remove(datablock)
 
   def default_camera_view(self):
     """Changes the UI so that the default view is from the camera POW."""
@@ -401,24 +541,53 @@ class Renderer(interface.Renderer):
         area for area in bpy.context.screen.areas if area.type == 'VIEW_3D')
     view3d.spaces[0].region_3d.view_perspective = 'CAMERA'
 
-  def set_up_exr_output(self, path):
-    bpy.context.scene.use_nodes = True
-    tree = bpy.context.scene.node_tree
+  def set_up_exr_output(self, path,
+                        layers=('Image', 'Depth', 'Vector', 'UV', 'Normal', 'CryptoObject00'),
+                        crypto_depth=2):
+    # activate only the render passes that are written, as each of them costs render time
+    view_layer = self._scene.view_layers['View Layer']
+    view_layer.use_pass_vector = 'Vector' in layers  # flow
+    view_layer.use_pass_uv = 'UV' in layers  # UV
+    view_layer.use_pass_normal = 'Normal' in layers  # surface normals
+    view_layer.cycles.use_pass_crypto_object = 'CryptoObject00' in layers  # segmentation
+    if view_layer.cycles.use_pass_crypto_object:
+      view_layer.cycles.pass_crypto_depth = crypto_depth
+    # with data passes, denoise only the final image once (OIDN) instead of during rendering
+    denoise_in_compositor = any(l in layers for l in ('Vector', 'UV', 'Normal', 'CryptoObject00'))
+    view_layer.cycles.use_denoising = not denoise_in_compositor
+
+    self._scene.use_nodes = True
+    tree = self._scene.node_tree
     links = tree.links
     render_node = tree.nodes.get('Render Layers')
 
+    image_output = render_node.outputs.get('Image')
+    if denoise_in_compositor:
+      # the normal/albedo feature passes guide the denoiser
+      view_layer.cycles.denoising_store_passes = True
+      denoise_node = tree.nodes.get('Denoise')
+      if denoise_node is None:
+        denoise_node = tree.nodes.new(type='CompositorNodeDenoise')
+      links.new(image_output, denoise_node.inputs.get('Image'))
+      for guide in ('Normal', 'Albedo'):
+        guide_output = render_node.outputs.get('Denoising ' + guide)
+        if guide_output is not None:
+          links.new(guide_output, denoise_node.inputs.get(guide))
+      image_output = denoise_node.outputs.get('Image')
+      # the main (e.g. PNG) output is denoised as well
+      links.new(image_output, tree.nodes.get('Composite').inputs.get('Image'))
+
     # create a new FileOutput node
     out_node = tree.nodes.new(type='CompositorNodeOutputFile')
     # set the format to EXR (multilayer)
     out_node.format.file_format = 'OPEN_EXR_MULTILAYER'
     out_node.base_path = path  # output directory
 
-    layers = ['Image', 'Depth', 'Vector', 'UV', 'Normal', 'CryptoObject00']
-
     out_node.file_slots.clear()
     for l in layers:
       out_node.file_slots.new(l)
-      links.new(render_node.outputs.get(l), out_node.inputs.get(l))
+      output = image_output if l == 'Image' else render_node.outputs.get(l)
+      links.new(output, out_node.inputs.get(l))
 
   def set_up_background(self, hdri_filepath=None, bg_color=None,
                              hdri_rotation=(0.0, 0.0, 0.0)):
@@ -434,9 +603,35 @@ class Renderer(interface.Renderer):
     """
     assert hdri_filepath is not None or bg_color is not None
 
-    bpy.context.scene.world.use_nodes = True
-    tree = bpy.context.scene.world.node_tree
+    self._scene.world.use_nodes = True
+    tree = self._scene.world.node_tree
+    layout = (hdri_filepath is not None, bg_color is not None)
+
+    # a tree with the same layout was already built: only swap the image/color
+    nodes = {key: tree.nodes.get(name) for key, name in Renderer._world_node_names.items()}
+    expected = {"mapping": layout[0], "hdri": layout[0], "camera_bg": layout[1]}
+    if any((nodes[key] is not None) != exists for key, exists in expected.items()):
+      nodes = self._build_world_ntree(tree, *layout)
+
+    if hdri_filepath is not None:
+      # load the actual image, packing forces it to be decoded before the first render tile
+      image = bpy.data.images.load(hdri_filepath, check_existing=True)
+      if not image.packed_file:
+        image.pack()
+      nodes["hdri"].image = image
+      nodes["hdri"].interpolation = 'Linear'
+      # set the rotation
+      nodes["mapping"].inputs.get('Rotation').default_value = hdri_rotation  # XYZ rotation of HDRI bg
+
+    if bg_color is not None:
+      # set bg color value
+      nodes["camera_bg"].inputs.get('Color').default_value = bg_color  # BG color RGBA
+
+  @staticmethod
+  def _build_world_ntree(tree, use_hdri: bool, use_bg_color: bool):
+    """Rebuilds the world node tree, returning the nodes that set_up_background configures."""
     links = tree.links
+    nodes = {}
 
     # clear the tree
     for node in tree.nodes.values():
@@ -446,7 +641,7 @@ class Renderer(interface.Renderer):
     out_node = tree.nodes.new(type='ShaderNodeOutputWorld')
     out_node.location = 1100, 0
 
-    if hdri_filepath is not None:
+    if use_hdri:
       coord_node = tree.nodes.new(type='ShaderNodeTexCoord')
       mapping_node = tree.nodes.new(type='ShaderNodeMapping')
       mapping_node.location = 200, 0
@@ -454,33 +649,31 @@ class Renderer(interface.Renderer):
       hdri_node.location = 400, 0
       light_bg_node = tree.nodes.new(type='ShaderNodeBackground')
       light_bg_node.location = 700, 0
+      nodes["mapping"], nodes["hdri"] = mapping_node, hdri_node
+      mapping_node.name = Renderer._world_node_names["mapping"]
+      hdri_node.name = Renderer._world_node_names["hdri"]
 
       # link nodes
       links.new(coord_node.outputs.get('Generated'), mapping_node.inputs.get('Vector'))
       links.new(mapping_node.outputs.get('Vector'), hdri_node.inputs.get('Vector'))
       links.new(hdri_node.outputs.get('Color'), light_bg_node.inputs.get('Color'))
 
-      # load the actual image
-      hdri_node.image = bpy.data.images.load(hdri_filepath, check_existing=True)
-      # set the rotation
-      mapping_node.inputs.get('Rotation').default_value = hdri_rotation  # XYZ rotation of HDRI bg
-
       # if no background color is set, then connect to output node
-      if bg_color is None:
+      if not use_bg_color:
         links.new(light_bg_node.outputs.get('Background'), out_node.inputs.get('Surface'))
 
-    if bg_color is not None:
+    if use_bg_color:
       camera_bg_node = tree.nodes.new(type='ShaderNodeBackground')
       camera_bg_node.location = 700, -120
-      # set bg color value
-      camera_bg_node.inputs.get('Color').default_value = bg_color  # BG color RGBA
+      nodes["camera_bg"] = camera_bg_node
+      camera_bg_node.name = Renderer._world_node_names["camera_bg"]
 
       # if no HDRI image is set, then connect to output node
-      if hdri_filepath is None:
+      if not use_hdri:
         links.new(camera_bg_node.outputs.get('Background'), out_node.inputs.get('Surface'))
 
     # if both are set, then use a mixing node and a lightpath input
-    if hdri_filepath is not None and bg_color is not None:
+    if use_hdri and use_bg_color:
       mix_node = tree.nodes.new(type='ShaderNodeMixShader')
       mix_node.location = 900, 0
       lightpath_node = tree.nodes.new(type='ShaderNodeLightPath')
@@ -490,23 +683,44 @@ class Renderer(interface.Renderer):
       links.new(light_bg_node.outputs.get('Background'), mix_node.inputs[1])
       links.new(camera_bg_node.outputs.get('Background'), mix_node.inputs[2])
       links.new(mix_node.outputs.get('Shader'), out_node.inputs.get('Surface'))
+    return nodes
+
+  def render_frames(self, frames: Iterable[int], on_render_write=None):
+    """Renders the given frames one at a time as stills named like animation frames.
+
+    This allows splitting an animation across several blender processes,
+    e.g. `frames=range(offset, frame_end + 1, stride)` in each of them.
+    """
+    render = self._render
+    path_template = render.filepath
+    try:
+      for frame in frames:
+        self._scene.frame_set(frame)
+        render.filepath = path_template
+        frame_path = render.frame_path(frame=frame)
+        render.filepath = frame_path
+        bpy.ops.render.render(write_still=True, animation=False)
+        if on_render_write:
+          on_render_write(frame_path)
+    finally:
+      render.filepath = path_template
 
   def render(self, scene: Scene, camera: Camera, path: str,
-      on_render_write=None):
+      on_render_write=None, frames: Iterable[int] = None):
     # --- adjusts resolution according to threejs style camera
     if isinstance(camera, OrthographicCamera):
       aspect = (camera.right - camera.left) * 1.0 / (camera.top - camera.bottom)
-      new_y_res = int(bpy.context.scene.render.resolution_x / aspect)
-      if new_y_res != bpy.context.scene.render.resolution_y:
+      new_y_res = int(self._render.resolution_x / aspect)
+      if new_y_res != self._render.resolution_y:
         print("WARNING: blender renderer adjusted the film resolution", end="")
-        print(new_y_res, bpy.context.scene.render.resolution_y)
-        bpy.context.scene.render.resolution_y = new_y_res
+        print(new_y_res, self._render.resolution_y)
+        self._render.resolution_y = new_y_res
 
     # --- Sets the default camera
-    bpy.context.scene.camera = camera._blender_object
+    self._scene.camera = camera._blender_object
 
     if not path.endswith(".blend"):
-      bpy.context.scene.render.filepath = path
+      self._render.filepath = path
 
     # --- creates blender file
     if path.endswith(".blend"):
@@ -517,11 +731,11 @@ class Renderer(interface.Renderer):
     elif path.endswith(".mov"):
       # WARNING: movies do not support transparency
       # TODO: actually they do, ask @bydeng for the needed blender config.
-      assert bpy.context.scene.render.film_transparent == False
-      bpy.context.scene.render.image_settings.file_format = "FFMPEG"
-      bpy.context.scene.render.image_settings.color_mode = "RGB"
-      bpy.context.scene.render.ffmpeg.format = "QUICKTIME"
-      bpy.context.scene.render.ffmpeg.codec = "H264"
+      assert self._render.film_transparent == False
+      self._render.image_settings.file_format = "FFMPEG"
+      self._render.image_settings.color_mode = "RGB"
+      self._render.ffmpeg.format = "QUICKTIME"
+      self._render.ffmpeg.codec = "H264"
 
     # --- renders one frame directly to a png file
     elif path.endswith(".png"):
@@ -529,9 +743,35 @@ class Renderer(interface.Renderer):
       bpy.ops.render.render(write_still=True, animation=False)
 
     # --- creates a movie as a image sequence {png}
+    # Convert to gif via ImageMagick: `convert -delay 8 -loop 0 *.png output.gif`
     else:
+      self._render_sequence(frames, on_render_write)
+
+  def _render_sequence(self, frames: Iterable[int] = None, on_render_write=None,
+                       max_workers: int = 4):
+    """Renders an image sequence (all frames if `frames` is None).
+
+    `on_render_write` (e.g. uploading the frame to a bucket) runs in a thread pool, so
+    that its I/O overlaps with rendering the following frames.
+    """
+    upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = []
+
+    def on_frame_written(frame_path: str):
       if on_render_write:
-        bpy.app.handlers.render_write.append(
-          lambda scene: on_render_write(scene.render.frame_path()))
-      # Convert to gif via ImageMagick: `convert -delay 8 -loop 0 *.png output.gif`
-      bpy.ops.render.render(write_still=True, animation=True)
+        futures.append(upload_pool.submit(on_render_write, frame_path))
+
+    try:
+      if frames is not None:
+        self.render_frames(frames, on_render_write=on_frame_written)
+      else:
+        handler = lambda scene: on_frame_written(scene.render.frame_path())
+        bpy.app.handlers.render_write.append(handler)
+        try:
+          bpy.ops.render.render(write_still=True, animation=True)
+        finally:
+          bpy.app.handlers.render_write.remove(handler)
+    finally:
+      upload_pool.shutdown(wait=True)
+    for future in futures:
+      future.result()  # re-raises exceptions of the callbacks
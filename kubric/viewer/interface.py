@@ -19,6 +19,7 @@ TODO:
 """
 
 import mathutils
+import numpy as np
 
 
 # ------------------------------------------------------------------------------
@@ -32,6 +33,48 @@ def hex_to_rgba(hexint: int, alpha=1.0):
   return [r / 255.0, g / 255.0, b / 255.0, alpha]
 
 
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+  return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def rotation_matrices_to_quaternions(matrices: np.ndarray) -> np.ndarray:
+  """Converts (N, 3, 3) rotation matrices into (N, 4) WXYZ quaternions (Shepperd's method)."""
+  m = np.asarray(matrices, dtype=np.float64)
+  m00, m11, m22 = m[:, 0, 0], m[:, 1, 1], m[:, 2, 2]
+  # compute all four candidates, and keep the numerically stable one (largest component)
+  diagonals = np.stack([m00 + m11 + m22, m00 - m11 - m22, m11 - m00 - m22, m22 - m00 - m11])
+  s = 2 * np.sqrt(np.maximum(1 + diagonals, 1e-12))  # (4, N)
+  d_zy, d_xz, d_yx = m[:, 2, 1] - m[:, 1, 2], m[:, 0, 2] - m[:, 2, 0], m[:, 1, 0] - m[:, 0, 1]
+  s_xy, s_xz, s_yz = m[:, 0, 1] + m[:, 1, 0], m[:, 0, 2] + m[:, 2, 0], m[:, 1, 2] + m[:, 2, 1]
+  candidates = np.stack([
+      np.stack([s[0] / 4, d_zy / s[0], d_xz / s[0], d_yx / s[0]], axis=-1),
+      np.stack([d_zy / s[1], s[1] / 4, s_xy / s[1], s_xz / s[1]], axis=-1),
+      np.stack([d_xz / s[2], s_xy / s[2], s[2] / 4, s_yz / s[2]], axis=-1),
+      np.stack([d_yx / s[3], s_xz / s[3], s_yz / s[3], s[3] / 4], axis=-1),
+  ])  # (4, N, 4)
+  best = np.argmax(diagonals, axis=0)
+  return candidates[best, np.arange(m.shape[0])]
+
+
+def numpy_look_at(positions, target=(0., 0., 0.), up=(0., 0., 1.)) -> np.ndarray:
+  """Vectorized version of `Object3D.look_at` for (N, 3) positions.
+
+  Returns (N, 4) WXYZ quaternions that point the local -Z axis towards `target`
+  (one per position or shared) and keep the local Y axis as close to `up` as possible.
+  """
+  positions = np.atleast_2d(np.asarray(positions, dtype=np.float64))
+  forward = _normalize(np.asarray(target, dtype=np.float64) - positions)
+  side = np.cross(forward, up)
+  # looking along `up` leaves the roll undefined: fall back to the world axis least aligned with it
+  fallback_up = np.eye(3)[np.argmin(np.abs(up))]
+  parallel = np.linalg.norm(side, axis=-1, keepdims=True) < 1e-6
+  side = _normalize(np.where(parallel, np.cross(forward, fallback_up), side))
+  up = np.cross(side, forward)
+  # columns are the local X, Y, Z axes expressed in world coordinates
+  matrices = np.stack([side, up, -forward], axis=-1)
+  return rotation_matrices_to_quaternions(matrices)
+
+
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
@@ -74,6 +117,9 @@ class Object3D(object):
   def keyframe_insert(self, member: str, frame: int):
     raise NotImplementedError
 
+  def keyframe_insert_batch(self, member: str, frames, values):
+    raise NotImplementedError
+
   def look_at(self, x, y, z):
     direction = mathutils.Vector((x, y, z)) - self.position
     # TODO: shouldn't we be using self.up here?
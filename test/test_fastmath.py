@@ -0,0 +1,23 @@
+# Copyright 2020 The Kubric Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from kubric.viewer._fastmath import pb_to_blender_quats
+
+
+def test_pb_to_blender_quats():
+  xyzw = np.array([[0.1, 0.2, 0.3, 0.9], [0., 0., 0., 1.]], dtype=np.float32)
+  wxyz = pb_to_blender_quats(xyzw)
+  assert wxyz.dtype == np.float32
+  np.testing.assert_array_equal(wxyz, xyzw[:, [3, 0, 1, 2]])
@@ -0,0 +1,53 @@
+# Copyright 2020 The Kubric Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mathutils
+import numpy as np
+import pytest
+from kubric.viewer import interface
+
+# (light positions from the CLEVR setup in worker.py)
+positions = [(-1.1685, 2.64602, 5.81574), (6.44671, -2.90517, 4.2584),
+             (-4.67112, -4.0136, 3.01122), (11.6608, -6.62799, 25.8232)]
+
+
+def test_numpy_look_at_matches_look_at():
+  quaternions = interface.numpy_look_at(positions, target=(0, 0, 0))
+  for position, quaternion in zip(positions, quaternions):
+    obj = interface.Object3D()
+    obj.position = position
+    obj.look_at(0, 0, 0)
+    expected = obj.quaternion.to_matrix()
+    assert np.allclose(mathutils.Quaternion(quaternion).to_matrix(), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("position,up", [((0, 0, 5), (0, 0, 1)), ((0, 5, 0), (0, 1, 0))])
+def test_numpy_look_at_from_above(position, up):
+  # the direction is parallel to the up axis
+  quaternion, = interface.numpy_look_at([position], target=(0, 0, 0), up=up)
+  assert np.all(np.isfinite(quaternion))
+  rotation = mathutils.Quaternion(quaternion).to_matrix()
+  expected = -mathutils.Vector(position).normalized()
+  assert np.allclose(rotation @ mathutils.Vector((0, 0, -1)), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_rotation_matrices_to_quaternions(seed):
+  rnd = np.random.RandomState(seed)
+  expected = [mathutils.Quaternion(q).normalized() for q in rnd.normal(size=(8, 4))]
+  matrices = np.array([q.to_matrix() for q in expected])
+  quaternions = interface.rotation_matrices_to_quaternions(matrices)
+  for quaternion, q in zip(quaternions, expected):
+    # q and -q encode the same rotation
+    assert abs(np.dot(quaternion, q)) == pytest.approx(1.0)
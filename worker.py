@@ -14,13 +14,20 @@
 
 import argparse
 import logging
+import multiprocessing
 import numpy as np
+import os
 import pathlib
-import pickle
+import posixpath
+from urllib.parse import urlparse
+
+from google.cloud import storage
 
 import sys; sys.path.append(".")
 
 import kubric.viewer.blender as THREE
+from kubric.viewer.interface import numpy_look_at
+from kubric.viewer._fastmath import pb_to_blender_quats
 from kubric.assets.asset_source import AssetSource
 from kubric.assets.utils import mm3hash
 from kubric.simulator import Simulator
@@ -37,12 +44,20 @@ parser.add_argument("--frame_rate", type=int, default=24)
 parser.add_argument("--step_rate", type=int, default=240)
 parser.add_argument("--frame_start", type=int, default=0)
 parser.add_argument("--frame_end", type=int, default=96)  # 4 seconds 
+parser.add_argument("--frame_stride", type=int, default=1,
+                    help="only render every n-th frame (e.g. one of n parallel blender processes)")
+parser.add_argument("--frame_offset", type=int, default=0,
+                    help="first frame to render, relative to --frame_start")
 parser.add_argument("--logging_level", type=str, default="INFO")
 parser.add_argument("--seed", type=int, default=0)
 parser.add_argument("--resolution", type=int, default=512)
 parser.add_argument("--randomize_color", type=bool, default=False)
 parser.add_argument("--outpath", type=str, default='./output/')
-parser.add_argument("--output", type=str, default='gs://kubric/output')  # TODO: actually copy results there
+parser.add_argument("--postprocess_workers", type=int, default=os.cpu_count(),
+                    help="number of processes decoding the rendered EXR files")
+parser.add_argument("--output", type=str, default=None,
+                    help="e.g. 'gs://kubric/output' to upload the rendered PNG frames and EXR "
+                         "layers to a bucket (defaults to writing them to --outpath only)")
 
 # --- parse argument in a way compatible with blender's REPL
 if "--" in sys.argv:
@@ -50,6 +65,12 @@ if "--" in sys.argv:
 else:
   FLAGS = parser.parse_args(args=[])
 
+if FLAGS.frame_stride < 1:
+  parser.error("--frame_stride must be >= 1, got {}".format(FLAGS.frame_stride))
+if FLAGS.frame_stride > 1 and not FLAGS.seed:
+  # every process re-creates and simulates the scene, so they all need the same one
+  parser.error("splitting frames with --frame_stride requires an explicit non-zero --seed")
+
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
@@ -59,9 +80,9 @@ logging.basicConfig(level=FLAGS.logging_level)
 
 # --- Configures random generator
 if FLAGS.seed:
-  rnd = np.random.RandomState(FLAGS.seed)
+  rnd = np.random.default_rng(FLAGS.seed)
 else:
-  rnd = np.random.RandomState()
+  rnd = np.random.default_rng()
 
 # --- Download a few models locally
 asset_source = AssetSource(uri=FLAGS.assets)
@@ -72,7 +93,7 @@ floor = asset_source.create({'id': 'Floor', 'static': True, 'position': (0, 0, -
 # --- Scene configuration (number of objects randomly scattered in a region)
 spawn_region = ((-4, -4, 0.8), (4, 4, 0.9))
 velocity_range = ((-4, -4, 0), (4, 4, 0))
-nr_objects = rnd.randint(4, 10)
+nr_objects = rnd.integers(4, 10)
 objects = []
 objects_list = [
     "LargeMetalCube",
@@ -92,9 +113,10 @@ objects_list = [
 ]
 
 for i in range(nr_objects):
-  objects.append(asset_source.create({'id': rnd.choice(objects_list),
-                                      'position': rnd.uniform(*spawn_region),
-                                      'linear_velocity': rnd.uniform(*velocity_range)}))
+  objects.append(asset_source.create({
+      'id': rnd.choice(objects_list),
+      'position': rnd.uniform(low=spawn_region[0], high=spawn_region[1], size=3),
+      'linear_velocity': rnd.uniform(low=velocity_range[0], high=velocity_range[1], size=3)}))
 
 # --- load models & place them in the simulator
 simulator = Simulator(frame_rate=FLAGS.frame_rate, step_rate=FLAGS.step_rate)
@@ -128,47 +150,71 @@ sun.quaternion = (0.971588, 0.105085, 0.210842, 0.022804)
 scene.add(sun)
 lamp_back = THREE.RectAreaLight(color=0xffffff, intensity=50., width=1, height=1)
 lamp_back.position = (-1.1685, 2.64602, 5.81574)
-lamp_back.look_at(0, 0, 0)
-scene.add(lamp_back)
 lamp_key = THREE.RectAreaLight(color=0xffedd0, intensity=100, width=0.5, height=0.5)
 lamp_key.position = (6.44671, -2.90517, 4.2584)
-lamp_key.look_at(0, 0, 0)
-scene.add(lamp_key)
 lamp_fill = THREE.RectAreaLight(color=0xc2d0ff, intensity=30, width=0.5, height=0.5)
 lamp_fill.position = (-4.67112, -4.0136, 3.01122)
-lamp_fill.look_at(0, 0, 0)
-scene.add(lamp_fill)
+lamps = [lamp_back, lamp_key, lamp_fill]
+# all lamps look at the origin
+lamp_quaternions = numpy_look_at([lamp.position for lamp in lamps], target=(0, 0, 0))
+for lamp, quaternion in zip(lamps, lamp_quaternions):
+  lamp.quaternion = quaternion
+  scene.add(lamp)
 
 
 # TODO: this is a hack. This conversion should be done automatically and internally.
-def translate_quat(pb_quat):
-  """ Convert pyBullet XYZW quaternions into Blender WXYZ quaternions."""
-  x, y, z, w = pb_quat
-  return [w, x, y, z]
+def translate_quats(pb_quats):
+  """ Convert (N, 4) pyBullet XYZW quaternions into Blender WXYZ quaternions."""
+  return pb_to_blender_quats(np.ascontiguousarray(pb_quats, dtype=np.float32))
 
 
 # --- Dump the simulation data in the renderer
-room = scene.add_from_file(str(floor.vis_filename))
+room = scene.add_from_file(str(floor.vis_filename), asset_id=floor.asset_id)
 room.position = floor.position
-room.quaternion = translate_quat(floor.rotation)
+room.quaternion = translate_quats([floor.rotation])[0]
 
 
-for obj in objects:
-  o = scene.add_from_file(str(obj.vis_filename), name=obj.uid)
+# --- gather the animation of all objects at once: (N, F, 3) positions, (N, F, 4) quaternions
+# (kept as float64 for the ground truth, only the keyframed copies are float32)
+pos_all = np.stack([animation[obj]["position"] for obj in objects])
+quat_all = np.stack([animation[obj]["orient_quat"] for obj in objects])
+quat_all_wxyz = translate_quats(quat_all.reshape(-1, 4)).reshape(quat_all.shape)
+
+frames = np.arange(scene.frame_start, scene.frame_end)
+for i, obj in enumerate(objects):
+  o = scene.add_from_file(str(obj.vis_filename), name=obj.uid, asset_id=obj.asset_id)
   o.position = obj.position
-  o.quaternion = translate_quat(obj.rotation)
+  o.quaternion = translate_quats([obj.rotation])[0]
 
   if FLAGS.randomize_color:
     logging.warning("TODO: color randomization")
     pass
 
-  for frame_id in range(scene.frame_start, scene.frame_end):
-    o.position = animation[obj]["position"][frame_id]
-    o.quaternion = translate_quat(animation[obj]["orient_quat"][frame_id])
-    o.keyframe_insert("position", frame_id)
-    o.keyframe_insert("quaternion", frame_id)
-
-renderer.render(scene, camera, path=FLAGS.output)
+  o.keyframe_insert_batch("position", frames, pos_all[i, frames].astype(np.float32))
+  o.keyframe_insert_batch("quaternion", frames, quat_all_wxyz[i, frames])
+
+render_frames = range(scene.frame_start + FLAGS.frame_offset, scene.frame_end + 1,
+                      FLAGS.frame_stride)
+render_path = str(pathlib.Path(FLAGS.outpath) / "frame_")
+on_render_write = None
+output = urlparse(FLAGS.output or FLAGS.outpath)
+if output.scheme == 'gs':
+  # upload each frame (and its EXR layers) while the next ones are rendering
+  bucket = storage.Client().bucket(output.netloc)
+
+  def on_render_write(frame_path: str):
+    # the File Output node writes the EXR layers of frame N as <outpath>/NNNN.exr
+    frame = int(pathlib.Path(frame_path).stem[len("frame_"):])
+    exr_path = pathlib.Path(FLAGS.outpath) / "{:04d}.exr".format(frame)
+    for path in [frame_path, str(exr_path)]:
+      blob_name = posixpath.join(output.path.lstrip('/'), pathlib.Path(path).name)
+      logging.info("uploading %s to gs://%s/%s", path, output.netloc, blob_name)
+      bucket.blob(blob_name).upload_from_filename(path)
+elif FLAGS.output:
+  render_path = FLAGS.output
+
+renderer.render(scene, camera, path=render_path, frames=render_frames,
+                on_render_write=on_render_write)
 
 # ------------------------------------------------------------------------------
 # ------------------------------------------------------------------------------
@@ -177,20 +223,25 @@ renderer.render(scene, camera, path=FLAGS.output)
 # TODO: add option to trigger gather of data from cloud bucket (or local file system)
 if False:
   # --- Postprocessing
-  layers = []
-  for frame_id in range(scene.frame_start, scene.frame_end):
-    layers.append(get_render_layers_from_exr(f'{FLAGS.outpath}/out{frame_id:04d}.exr'))
-
-  gt_factors = []
-  for obj in objects:
-    gt_factors.append({
-      'mass': obj.mass,
-      'asset_id': obj.asset_id,
-      'crypto_id': mm3hash(obj.uid),   # TODO: adjust segmentation maps instead
-      'animation': animation[obj],
-    })
+  # decoding the EXRs is independent per frame (imap, unlike imap_unordered, keeps frame order)
+  exr_paths = [f'{FLAGS.outpath}/out{frame_id:04d}.exr'
+               for frame_id in range(scene.frame_start, scene.frame_end)]
+  with multiprocessing.Pool(FLAGS.postprocess_workers) as pool:
+    layers = list(pool.imap(get_render_layers_from_exr, exr_paths, chunksize=4))
+
+  # stored as one (F, H, W, C) array per layer and one (N, ...) array per factor
+  gt_factors = {
+    'mass': np.array([np.nan if obj.mass is None else obj.mass for obj in objects]),
+    'asset_id': np.array([obj.asset_id for obj in objects]),
+    # TODO: adjust segmentation maps instead
+    'crypto_id': np.array([mm3hash(obj.uid) for obj in objects], dtype=np.uint32),
+    'position': pos_all,
+    'orient_quat': quat_all,
+  }
+  layers = {name: np.stack([frame_layers[name] for frame_layers in layers])
+            for name in layers[0]}
 
   # TODO: convert to TFrecords
-  with open(FLAGS.outpath + '/layers.pkl', 'wb') as f:
-    pickle.dump({'layers': layers, 'factors': gt_factors}, f)
-
+  np.savez_compressed(FLAGS.outpath + '/layers.npz',
+                      **{'layers/' + name: layer for name, layer in layers.items()},
+                      **{'factors/' + name: factor for name, factor in gt_factors.items()})